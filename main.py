@@ -1,25 +1,23 @@
 import os
-import json
-from datetime import datetime
-from typing import Optional, Any, Dict, List
-from io import StringIO
-import csv
-
-from fastapi import FastAPI, HTTPException, Depends, Header, Query
-from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+import asyncio
+import time
+import hashlib
+import hmac
+import uuid
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from typing import Optional, Any, AsyncIterator, Dict, List, Tuple
+
+from fastapi import FastAPI, HTTPException, Depends, Query, Request, Response
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel, Field
 
-import psycopg
-from psycopg.rows import dict_row
-from psycopg_pool import ConnectionPool
+import asyncpg
+import orjson
 
 def normalize_session_id(s: str) -> str:
     return (s or "").replace("-", "").upper()
 
-class RestartClickPayload(BaseModel):
-    session_id: str
-
 # -----------------------------
 # Config & helpers
 # -----------------------------
@@ -35,35 +33,180 @@ def resolve_db_url() -> str:
 DATABASE_URL = resolve_db_url()
 API_KEY = os.environ.get("API_KEY")
 
-def require_api_key(authorization: Optional[str] = Header(None)) -> None:
-    if not API_KEY:
-        return 
-    if not authorization or not authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Missing bearer token")
-    token = authorization.split(" ", 1)[1].strip()
-    if token != API_KEY:
-        raise HTTPException(status_code=403, detail="Invalid API key")
-
-pool = ConnectionPool(
-    conninfo=DATABASE_URL,
-    min_size=0,
-    max_size=5,
-    kwargs={"row_factory": dict_row, "autocommit": True},
-)
+# Per-worker pool: min_size connections are opened before startup completes, so
+# the first request never pays the connect/TLS/auth handshake.
+DB_POOL_MIN_SIZE = int(os.environ.get("DB_POOL_MIN_SIZE", "2"))
+DB_POOL_MAX_SIZE = int(os.environ.get("DB_POOL_MAX_SIZE", "20"))
+
+# Reachable without a bearer token: platform health probes and the API docs
+AUTH_EXEMPT_PATHS = frozenset({"/health", "/docs", "/docs/oauth2-redirect", "/redoc", "/openapi.json"})
+
+class ApiKeyMiddleware:
+    # Checks the bearer token on the raw ASGI headers before routing, instead of a
+    # Depends() resolved on every route
+    def __init__(self, app, api_key: Optional[str]) -> None:
+        self.app = app
+        self.api_key = api_key.encode() if api_key else None
+        self.missing = orjson.dumps({"detail": "Missing bearer token"})
+        self.invalid = orjson.dumps({"detail": "Invalid API key"})
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http" or self.api_key is None or scope["path"] in AUTH_EXEMPT_PATHS:
+            await self.app(scope, receive, send)
+            return
+
+        authorization = next((v for k, v in scope["headers"] if k == b"authorization"), None)
+        if not authorization or not authorization.startswith(b"Bearer "):
+            await self.reject(send, 401, self.missing)
+            return
+        if not hmac.compare_digest(authorization[7:].strip(), self.api_key):
+            await self.reject(send, 403, self.invalid)
+            return
+        await self.app(scope, receive, send)
+
+    @staticmethod
+    async def reject(send, status: int, body: bytes) -> None:
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+# Bounds on client-supplied session meta, checked before it reaches the database
+MAX_META_KEYS = 200
+MAX_META_BYTES = 32_768
+
+def check_meta_size(meta: Optional[Dict[str, Any]]) -> None:
+    if not meta:
+        return
+    try:
+        encoded = orjson.dumps(meta)
+    except orjson.JSONEncodeError:
+        # e.g. integers beyond 64 bits, which orjson (and so the jsonb codec) can't encode
+        raise HTTPException(status_code=422, detail="meta is not encodable as JSON")
+    if len(encoded) > MAX_META_BYTES:
+        raise HTTPException(status_code=413, detail=f"meta exceeds {MAX_META_BYTES} bytes")
+
+JSONB_FORMAT_VERSION = b"\x01"
+
+async def init_connection(conn: asyncpg.Connection) -> None:
+    # Let asyncpg encode/decode meta as JSON so handlers can pass dicts straight through.
+    # Binary format skips the bytes<->str round-trip; jsonb's wire format is a version byte + JSON text.
+    await conn.set_type_codec(
+        "json",
+        encoder=orjson.dumps,
+        decoder=orjson.loads,
+        schema="pg_catalog",
+        format="binary",
+    )
+    await conn.set_type_codec(
+        "jsonb",
+        encoder=lambda v: JSONB_FORMAT_VERSION + orjson.dumps(v),
+        decoder=lambda b: orjson.loads(b[1:]),
+        schema="pg_catalog",
+        format="binary",
+    )
+
+pool: Optional[asyncpg.Pool] = None
+
+async def get_conn() -> AsyncIterator[asyncpg.Connection]:
+    # One pooled connection per request, released when the handler returns
+    async with pool.acquire() as conn:
+        yield conn
+
+# Per-process TTL cache for read endpoints: key -> (expires_at, value)
+KIOSKS_TTL = 300.0
+METRICS_TTL = 30.0
+READ_CACHE_CONTROL = "private, max-age=30"
+KIOSKS_CACHE_CONTROL = "private, max-age=60"
+_read_cache: Dict[Tuple[Any, ...], Tuple[float, Any]] = {}
+
+def cache_get(key: Tuple[Any, ...]) -> Any:
+    hit = _read_cache.get(key)
+    if hit is None or hit[0] <= time.monotonic():
+        return None
+    return hit[1]
+
+def cache_put(key: Tuple[Any, ...], value: Any, ttl: float) -> Any:
+    now = time.monotonic()
+    if len(_read_cache) >= 256:
+        # Arbitrary date windows would otherwise grow the cache forever
+        for k in [k for k, (expires_at, _) in _read_cache.items() if expires_at <= now]:
+            del _read_cache[k]
+    _read_cache[key] = (now + ttl, value)
+    return value
+
+CORS_ALLOW_ORIGIN = (b"access-control-allow-origin", b"*")
+CORS_PREFLIGHT_HEADERS = [
+    CORS_ALLOW_ORIGIN,
+    (b"access-control-allow-methods", b"GET, POST, OPTIONS"),
+    # Authorization is never covered by the "*" wildcard, so it is listed explicitly
+    (b"access-control-allow-headers", b"Authorization, *"),
+    (b"access-control-max-age", b"600"),
+    (b"content-length", b"0"),
+]
+
+class FastCORS:
+    # Any origin, no credentials: OPTIONS gets a fixed 204, everything else gets one appended
+    # header, skipping CORSMiddleware's per-request origin/method/header matching
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        if scope["method"] == "OPTIONS":
+            await send({"type": "http.response.start", "status": 204, "headers": CORS_PREFLIGHT_HEADERS})
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        async def send_with_cors(message) -> None:
+            if message["type"] == "http.response.start":
+                message["headers"] = [*message.get("headers", ()), CORS_ALLOW_ORIGIN]
+            await send(message)
+
+        await self.app(scope, receive, send_with_cors)
 
 # -----------------------------
 # FastAPI app
 # -----------------------------
-app = FastAPI(title="Kiosk Sessions API", version="1.2.0")
-
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=False,
-    allow_methods=["*"],
-    allow_headers=["*"],
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    global pool
+    pool = await asyncpg.create_pool(
+        DATABASE_URL,
+        min_size=DB_POOL_MIN_SIZE,
+        max_size=DB_POOL_MAX_SIZE,
+        max_queries=10000,
+        max_inactive_connection_lifetime=300.0,
+        init=init_connection,
+        # Sent in the startup packet, so they cost nothing per connection
+        server_settings={
+            "application_name": "kiosk-api",
+            "statement_timeout": "5s",
+            "idle_in_transaction_session_timeout": "10s",
+        },
+    )
+    try:
+        yield
+    finally:
+        await pool.close()
+
+app = FastAPI(
+    title="Kiosk Sessions API",
+    version="1.2.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan,
 )
 
+# Added before CORS so CORS stays outermost: preflights never hit auth, and 401/403s get CORS headers
+app.add_middleware(ApiKeyMiddleware, api_key=API_KEY)
+
+app.add_middleware(FastCORS)
+
 # -----------------------------
 # Models
 # -----------------------------
@@ -76,13 +219,13 @@ class CompleteSessionIn(BaseModel):
     session_id: str
     kiosk_id: str    # <--- Added so the server knows where to assign offline data
     client_ms: Optional[int] = None
-    meta: Optional[Dict[str, Any]] = None
+    meta: Optional[Dict[str, Any]] = Field(default=None, max_length=MAX_META_KEYS)
 
 class AbandonSessionIn(BaseModel):
     session_id: str
     kiosk_id: str    # <--- Added so the server knows where to assign offline data
     client_ms: Optional[int] = None
-    meta: Optional[Dict[str, Any]] = None
+    meta: Optional[Dict[str, Any]] = Field(default=None, max_length=MAX_META_KEYS)
 
 class RestartSessionIn(BaseModel):
     session_id: str
@@ -90,224 +233,483 @@ class RestartSessionIn(BaseModel):
 # -----------------------------
 # Routes (The Upserts)
 # -----------------------------
-@app.post("/session/start", dependencies=[Depends(require_api_key)])
-def start_session(payload: StartSessionIn):
-    with pool.connection() as conn, conn.cursor() as cur:
-        # Check if kiosk exists
-        cur.execute("SELECT 1 FROM kiosk_locations WHERE kiosk_id = %s;", (payload.kiosk_id,))
-        if cur.fetchone() is None:
-            raise HTTPException(status_code=400, detail="Unknown kiosk_id")
-
-        # Insert, or do nothing if the GUID already made it
-        cur.execute(
-            """
+@app.post("/session/start")
+async def start_session(payload: StartSessionIn, conn: asyncpg.Connection = Depends(get_conn)):
+    # Check the kiosk and insert in one round-trip; do nothing if the GUID already made it.
+    # The kiosk check is returned separately so a duplicate GUID isn't mistaken for a bad kiosk.
+    known = await conn.fetchval(
+        """
+        WITH k AS (
+            SELECT EXISTS (SELECT 1 FROM kiosk_locations WHERE kiosk_id = $2) AS known
+        ), ins AS (
             INSERT INTO sessions (session_id, kiosk_id, app_version)
-            VALUES (%s, %s, %s)
+            SELECT $1::uuid, $2, $3::text FROM k WHERE k.known
             ON CONFLICT (session_id) DO NOTHING
-            RETURNING session_id, started_at;
-            """,
-            (payload.session_id, payload.kiosk_id, payload.app_version),
-        )
-        conn.commit()
-        return {"ok": True, "session_id": payload.session_id}
-
-@app.post("/session/complete", dependencies=[Depends(require_api_key)])
-def complete_session(payload: CompleteSessionIn):
-    with pool.connection() as conn, conn.cursor() as cur:
-        # The Upsert: Update if exists, Insert if offline Start was missed
-        cur.execute(
-            """
-            INSERT INTO sessions (session_id, kiosk_id, completed_at, client_ms, meta)
-            VALUES (%s, %s, NOW(), %s, %s)
-            ON CONFLICT (session_id) DO UPDATE 
-            SET completed_at = EXCLUDED.completed_at,
-                client_ms    = COALESCE(EXCLUDED.client_ms, sessions.client_ms),
-                meta         = COALESCE(EXCLUDED.meta, sessions.meta)
-            RETURNING session_id;
-            """,
-            (payload.session_id, payload.kiosk_id, payload.client_ms, json.dumps(payload.meta) if payload.meta else None),
-        )
-        conn.commit()
-        return {"ok": True, "session_id": payload.session_id}
-
-@app.post("/session/abandon", dependencies=[Depends(require_api_key)])
-def abandon_session(payload: AbandonSessionIn):
-    with pool.connection() as conn, conn.cursor() as cur:
-        # The Upsert: Update if exists, Insert if offline Start was missed
-        cur.execute(
-            """
-            INSERT INTO sessions (session_id, kiosk_id, abandoned_at, client_ms, meta)
-            VALUES (%s, %s, NOW(), %s, %s)
-            ON CONFLICT (session_id) DO UPDATE 
-            SET abandoned_at = EXCLUDED.abandoned_at,
-                client_ms    = COALESCE(EXCLUDED.client_ms, sessions.client_ms),
-                meta         = COALESCE(EXCLUDED.meta, sessions.meta)
-            RETURNING session_id;
-            """,
-            (payload.session_id, payload.kiosk_id, payload.client_ms, json.dumps(payload.meta) if payload.meta else None),
         )
-        conn.commit()
-        return {"ok": True, "session_id": payload.session_id}
-
-@app.post("/session/restart", dependencies=[Depends(require_api_key)])
-def restart_session(payload: RestartSessionIn):
-    with pool.connection() as conn, conn.cursor() as cur:
-        # Increment the restart counter for this specific session
-        cur.execute(
-            """
-            UPDATE sessions 
-            SET restart_clicks = COALESCE(restart_clicks, 0) + 1
-            WHERE session_id = %s
-            RETURNING session_id;
-            """,
-            (payload.session_id,)
+        SELECT known FROM k;
+        """,
+        payload.session_id, payload.kiosk_id, payload.app_version,
+    )
+    if not known:
+        raise HTTPException(status_code=400, detail="Unknown kiosk_id")
+    return {"ok": True, "session_id": payload.session_id}
+
+@app.post("/session/complete")
+async def complete_session(payload: CompleteSessionIn, conn: asyncpg.Connection = Depends(get_conn)):
+    check_meta_size(payload.meta)
+    # The Upsert: Update if exists, Insert if offline Start was missed
+    await conn.execute(
+        """
+        INSERT INTO sessions (session_id, kiosk_id, completed_at, client_ms, meta, completed_ms)
+        VALUES ($1, $2, NOW(), $3::bigint, $4, $3::bigint)
+        ON CONFLICT (session_id) DO UPDATE 
+        SET completed_at = EXCLUDED.completed_at,
+            client_ms    = COALESCE(EXCLUDED.client_ms, sessions.client_ms),
+            meta         = COALESCE(EXCLUDED.meta, sessions.meta),
+            completed_ms = COALESCE(EXCLUDED.completed_ms,
+                                    (EXTRACT(EPOCH FROM (EXCLUDED.completed_at - sessions.started_at)) * 1000)::bigint);
+        """,
+        payload.session_id, payload.kiosk_id, payload.client_ms, payload.meta or None,
+    )
+    return {"ok": True, "session_id": payload.session_id}
+
+@app.post("/session/abandon")
+async def abandon_session(payload: AbandonSessionIn, conn: asyncpg.Connection = Depends(get_conn)):
+    check_meta_size(payload.meta)
+    # The Upsert: Update if exists, Insert if offline Start was missed
+    await conn.execute(
+        """
+        INSERT INTO sessions (session_id, kiosk_id, abandoned_at, client_ms, meta, abandoned_ms)
+        VALUES ($1, $2, NOW(), $3::bigint, $4, $3::bigint)
+        ON CONFLICT (session_id) DO UPDATE 
+        SET abandoned_at = EXCLUDED.abandoned_at,
+            client_ms    = COALESCE(EXCLUDED.client_ms, sessions.client_ms),
+            meta         = COALESCE(EXCLUDED.meta, sessions.meta),
+            abandoned_ms = COALESCE(EXCLUDED.abandoned_ms,
+                                    (EXTRACT(EPOCH FROM (EXCLUDED.abandoned_at - sessions.started_at)) * 1000)::bigint);
+        """,
+        payload.session_id, payload.kiosk_id, payload.client_ms, payload.meta or None,
+    )
+    return {"ok": True, "session_id": payload.session_id}
+
+@app.post("/session/restart")
+async def restart_session(payload: RestartSessionIn, conn: asyncpg.Connection = Depends(get_conn)):
+    # Increment the restart counter for this specific session
+    await conn.execute(
+        """
+        UPDATE sessions 
+        SET restart_clicks = COALESCE(restart_clicks, 0) + 1
+        WHERE session_id = $1;
+        """,
+        payload.session_id,
+    )
+    return {"ok": True, "session_id": payload.session_id}
+
+# ------ Bulk endpoints (queued kiosk events, one round-trip per batch) ------
+def parse_session_ids(items) -> List[uuid.UUID]:
+    # Parsed up front so one bad id is a 422 rather than a DataError mid-statement, and so
+    # different spellings of the same UUID compare equal
+    ids = []
+    for p in items:
+        try:
+            ids.append(uuid.UUID(p.session_id))
+        except ValueError:
+            raise HTTPException(status_code=422, detail=f"Invalid session_id: {p.session_id}")
+    return ids
+
+@app.post("/session/start/bulk")
+async def start_sessions_bulk(payload: List[StartSessionIn], conn: asyncpg.Connection = Depends(get_conn)):
+    if not payload:
+        return {"ok": True, "session_ids": []}
+
+    # Nothing is inserted if any kiosk_id in the batch is unknown
+    unknown = await conn.fetchval(
+        """
+        WITH batch AS (
+            SELECT *
+            FROM unnest($1::uuid[], $2::text[], $3::text[]) AS b(session_id, kiosk_id, app_version)
+        ), unknown AS (
+            SELECT DISTINCT kiosk_id
+            FROM batch
+            WHERE NOT EXISTS (SELECT 1 FROM kiosk_locations k WHERE k.kiosk_id = batch.kiosk_id)
+        ), ins AS (
+            INSERT INTO sessions (session_id, kiosk_id, app_version)
+            SELECT session_id, kiosk_id, app_version
+            FROM batch
+            WHERE NOT EXISTS (SELECT 1 FROM unknown)
+            ON CONFLICT (session_id) DO NOTHING
         )
-        conn.commit()
-        return {"ok": True, "session_id": payload.session_id}
+        SELECT array_agg(kiosk_id) FROM unknown;
+        """,
+        parse_session_ids(payload),
+        [p.kiosk_id for p in payload],
+        [p.app_version for p in payload],
+    )
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown kiosk_id: {', '.join(sorted(unknown))}")
+    return {"ok": True, "session_ids": [p.session_id for p in payload]}
+
+@app.post("/session/complete/bulk")
+async def complete_sessions_bulk(payload: List[CompleteSessionIn], conn: asyncpg.Connection = Depends(get_conn)):
+    # ON CONFLICT DO UPDATE can't touch the same row twice in one statement, so keep the last event per session
+    latest = dict(zip(parse_session_ids(payload), payload))
+    for p in latest.values():
+        check_meta_size(p.meta)
+    if not latest:
+        return {"ok": True, "session_ids": []}
+
+    await conn.execute(
+        """
+        INSERT INTO sessions (session_id, kiosk_id, completed_at, client_ms, meta, completed_ms)
+        SELECT session_id, kiosk_id, NOW(), client_ms, meta, client_ms
+        FROM unnest($1::uuid[], $2::text[], $3::bigint[], $4::jsonb[]) AS b(session_id, kiosk_id, client_ms, meta)
+        ON CONFLICT (session_id) DO UPDATE
+        SET completed_at = EXCLUDED.completed_at,
+            client_ms    = COALESCE(EXCLUDED.client_ms, sessions.client_ms),
+            meta         = COALESCE(EXCLUDED.meta, sessions.meta),
+            completed_ms = COALESCE(EXCLUDED.completed_ms,
+                                    (EXTRACT(EPOCH FROM (EXCLUDED.completed_at - sessions.started_at)) * 1000)::bigint);
+        """,
+        list(latest),
+        [p.kiosk_id for p in latest.values()],
+        [p.client_ms for p in latest.values()],
+        [p.meta or None for p in latest.values()],
+    )
+    return {"ok": True, "session_ids": [p.session_id for p in latest.values()]}
+
+@app.post("/session/restart/bulk")
+async def restart_sessions_bulk(payload: List[RestartSessionIn], conn: asyncpg.Connection = Depends(get_conn)):
+    if not payload:
+        return {"ok": True, "session_ids": []}
+
+    # Repeated clicks on the same session are summed so each row is updated once
+    await conn.execute(
+        """
+        UPDATE sessions s
+        SET restart_clicks = COALESCE(s.restart_clicks, 0) + c.n
+        FROM (
+            SELECT id, COUNT(*) AS n
+            FROM unnest($1::uuid[]) AS id
+            GROUP BY id
+        ) c
+        WHERE s.session_id = c.id;
+        """,
+        parse_session_ids(payload),
+    )
+    return {"ok": True, "session_ids": [p.session_id for p in payload]}
+
+# ------ Health ------
+DB_PING_ACQUIRE_TIMEOUT = 0.25
+DB_PING_QUERY_TIMEOUT = 0.5
+DB_PING_TTL = 1.0
+_db_ping: Optional[Tuple[float, datetime]] = None  # (monotonic time, server now())
+_db_ping_lock = asyncio.Lock()
+
+@app.get("/health")
+async def health():
+    return {"ok": True}
+
+@app.get("/db/ping")
+async def db_ping():
+    global _db_ping
+    # Rapid probes share one round-trip, and never queue behind real traffic for a pool slot.
+    # Both waits are bounded since later probes queue on the lock; an unreachable database is degraded too.
+    async with _db_ping_lock:
+        if _db_ping is None or time.monotonic() - _db_ping[0] > DB_PING_TTL:
+            try:
+                async with pool.acquire(timeout=DB_PING_ACQUIRE_TIMEOUT) as conn:
+                    now = await conn.fetchval("SELECT now();", timeout=DB_PING_QUERY_TIMEOUT)
+            except (asyncio.TimeoutError, OSError, asyncpg.PostgresError, asyncpg.InterfaceError):
+                return ORJSONResponse(status_code=503, content={"ok": False, "degraded": True})
+            _db_ping = (time.monotonic(), now)
+    return {"ok": True, "now": _db_ping[1]}
 
 # ------ Kiosks endpoint ------
-@app.get("/kiosks", dependencies=[Depends(require_api_key)])
-def get_kiosks():
-    with pool.connection() as conn, conn.cursor() as cur:
-        cur.execute("SELECT kiosk_id, kiosk_name FROM kiosk_locations ORDER BY kiosk_name;")
-        return cur.fetchall()
+_kiosks_refill_lock = asyncio.Lock()
+
+@app.get("/kiosks")
+async def get_kiosks(request: Request):
+    # Cache the encoded body and its ETag so unchanged lists skip the DB and JSON encoding
+    key = ("kiosks",)
+    cached = cache_get(key)
+    if cached is None:
+        # Only one request refills an expired entry; the rest wait and reuse it
+        async with _kiosks_refill_lock:
+            cached = cache_get(key)
+            if cached is None:
+                async with pool.acquire() as conn:
+                    # Postgres builds the JSON array; cast to text so the jsonb codec doesn't decode it
+                    body = (await conn.fetchval(
+                        """
+                        SELECT COALESCE(
+                            json_agg(json_build_object('kiosk_id', kiosk_id, 'kiosk_name', kiosk_name) ORDER BY kiosk_name),
+                            '[]'
+                        )::text
+                        FROM kiosk_locations;
+                        """
+                    )).encode()
+                etag = f'W/"{hashlib.blake2b(body, digest_size=8).hexdigest()}"'
+                cached = cache_put(key, (body, etag), KIOSKS_TTL)
+
+    body, etag = cached
+    headers = {"ETag": etag, "Cache-Control": KIOSKS_CACHE_CONTROL}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
 
 
 # ----- Metrics -----
-@app.get("/metrics/overview", dependencies=[Depends(require_api_key)])
-def metrics_overview(
-    kiosk_id: Optional[str] = Query(default=None),
-    date_from: Optional[str] = Query(default=None),
-    date_to:   Optional[str] = Query(default=None),
-):
-    sql = """
-        WITH base AS (
-            SELECT *
-            FROM sessions
-            WHERE (%s::timestamptz IS NULL OR started_at >= %s::timestamptz)
-              AND (%s::timestamptz IS NULL OR started_at <  %s::timestamptz)
-              AND (%s::text IS NULL OR kiosk_id = %s)
-        )
-        SELECT
-            COUNT(*) AS sessions_started,
-            COUNT(*) FILTER (WHERE completed_at IS NOT NULL) AS sessions_completed,
-            COUNT(*) FILTER (WHERE abandoned_at IS NOT NULL) AS sessions_abandoned,
-            SUM(COALESCE(restart_clicks,0)) AS restart_clicks,
-            AVG(COALESCE(client_ms, EXTRACT(EPOCH FROM (completed_at - started_at)) * 1000)) FILTER (WHERE completed_at IS NOT NULL) AS avg_completed_ms,
-            AVG(COALESCE(client_ms, EXTRACT(EPOCH FROM (abandoned_at - started_at)) * 1000)) FILTER (WHERE abandoned_at IS NOT NULL) AS avg_abandoned_ms,
-            SUM((meta->>'download_app_clicks')::numeric) AS download_app_clicks,
-            SUM((meta->>'click_location_clicks')::numeric) AS click_location_clicks,
-            SUM((meta->>'back_to_map_clicks')::numeric) AS back_to_map_sessions,
-            AVG((meta->>'easter_eggs')::numeric) AS avg_easter_eggs,
-            SUM((meta->'poi_clicks'->>'Priority Pass')::numeric) AS poi_1,
-            SUM((meta->'poi_clicks'->>'Barcode Booth')::numeric) AS poi_2,
-            SUM((meta->'poi_clicks'->>'Support Spotlight')::numeric) AS poi_3,
-            SUM((meta->'poi_clicks'->>'Self Service Station')::numeric) AS poi_4,
-            SUM((meta->'poi_clicks'->>'Cash Concession')::numeric) AS poi_5
-        FROM base;
-    """
-    with pool.connection() as conn, conn.cursor() as cur:
-        cur.execute(sql, (date_from, date_from, date_to, date_to, kiosk_id, kiosk_id))
-        row = cur.fetchone() or {}
-
-    sessions_completed = int(row.get("sessions_completed", 0) or 0)
-    restart_clicks = int(row.get("restart_clicks", 0) or 0)
-    restart_rate = (float(restart_clicks) / float(sessions_completed)) if sessions_completed else 0.0
-
-    poi_clicks = {
-        "Priority Pass": int(row.get("poi_1") or 0),
-        "Barcode Booth": int(row.get("poi_2") or 0),
-        "Support Spotlight": int(row.get("poi_3") or 0),
-        "Self Service Station": int(row.get("poi_4") or 0),
-        "Cash Concession": int(row.get("poi_5") or 0),
+# Aggregate columns shared by the overview, by-kiosk and combined queries.
+# Cast in SQL so asyncpg hands back plain int/float (or None for empty averages).
+METRIC_COLUMNS = """
+    COUNT(*) AS started,
+    COUNT(*) FILTER (WHERE completed_at IS NOT NULL) AS completed,
+    COUNT(*) FILTER (WHERE abandoned_at IS NOT NULL) AS abandoned,
+    COALESCE(SUM(restart_clicks), 0)::bigint AS restart_clicks,
+    (AVG(completed_ms) FILTER (WHERE completed_at IS NOT NULL))::float8 AS avg_completed_ms,
+    (AVG(abandoned_ms) FILTER (WHERE abandoned_at IS NOT NULL))::float8 AS avg_abandoned_ms,
+    COALESCE(SUM((meta->>'download_app_clicks')::numeric), 0)::bigint AS download_app_clicks,
+    COALESCE(SUM((meta->>'click_location_clicks')::numeric), 0)::bigint AS click_location_clicks,
+    COALESCE(SUM((meta->>'back_to_map_clicks')::numeric), 0)::bigint AS back_to_map_sessions,
+    AVG((meta->>'easter_eggs')::numeric)::float8 AS avg_easter_eggs,
+    AVG((meta->>'screenindex')::numeric)::float8 AS avg_screen_depth,
+    COALESCE(SUM((meta->'poi_clicks'->>'Priority Pass')::numeric), 0)::bigint AS poi_1,
+    COALESCE(SUM((meta->'poi_clicks'->>'Barcode Booth')::numeric), 0)::bigint AS poi_2,
+    COALESCE(SUM((meta->'poi_clicks'->>'Support Spotlight')::numeric), 0)::bigint AS poi_3,
+    COALESCE(SUM((meta->'poi_clicks'->>'Self Service Station')::numeric), 0)::bigint AS poi_4,
+    COALESCE(SUM((meta->'poi_clicks'->>'Cash Concession')::numeric), 0)::bigint AS poi_5
+"""
+
+def as_utc(dt: Optional[datetime]) -> Optional[datetime]:
+    # A date sent without an offset is UTC; asyncpg would otherwise read it in the app host's local time
+    if dt is not None and dt.tzinfo is None:
+        return dt.replace(tzinfo=timezone.utc)
+    return dt
+
+def poi_clicks_from_row(r) -> Dict[str, int]:
+    return {
+        "Priority Pass": r["poi_1"],
+        "Barcode Booth": r["poi_2"],
+        "Support Spotlight": r["poi_3"],
+        "Self Service Station": r["poi_4"],
+        "Cash Concession": r["poi_5"],
     }
 
+def overview_from_row(row, kiosk_id: Optional[str], date_from: Optional[datetime], date_to: Optional[datetime]) -> Dict[str, Any]:
+    completed = row["completed"]
+    restart_clicks = row["restart_clicks"]
+
     return {
         "scope": kiosk_id,
         "date_from": date_from,
         "date_to": date_to,
-        "sessions_started": int(row.get("sessions_started", 0) or 0),
-        "sessions_completed": sessions_completed,
-        "sessions_abandoned": int(row.get("sessions_abandoned", 0) or 0),
+        "sessions_started": row["started"],
+        "sessions_completed": completed,
+        "sessions_abandoned": row["abandoned"],
         "restart_clicks": restart_clicks,
-        "restart_rate": restart_rate,
-        "avg_completed_ms": float(row.get("avg_completed_ms")) if row.get("avg_completed_ms") else None,
-        "avg_abandoned_ms": float(row.get("avg_abandoned_ms")) if row.get("avg_abandoned_ms") else None,
-        "download_app_clicks": int(row.get("download_app_clicks") or 0),
-        "click_location_clicks": int(row.get("click_location_clicks") or 0),
-        "back_to_map_sessions": int(row.get("back_to_map_sessions") or 0),
-        "avg_easter_eggs": float(row.get("avg_easter_eggs")) if row.get("avg_easter_eggs") else None,
-        "poi_clicks": poi_clicks
+        "restart_rate": restart_clicks / completed if completed else 0.0,
+        "avg_completed_ms": row["avg_completed_ms"] or None,
+        "avg_abandoned_ms": row["avg_abandoned_ms"] or None,
+        "download_app_clicks": row["download_app_clicks"],
+        "click_location_clicks": row["click_location_clicks"],
+        "back_to_map_sessions": row["back_to_map_sessions"],
+        "avg_easter_eggs": row["avg_easter_eggs"] or None,
+        "poi_clicks": poi_clicks_from_row(row)
     }
 
-@app.get("/metrics/by-kiosk", dependencies=[Depends(require_api_key)])
-def metrics_by_kiosk(
-    date_from: Optional[str] = Query(default=None),
-    date_to:   Optional[str] = Query(default=None),
+def by_kiosk_from_row(r) -> Dict[str, Any]:
+    completed = r["completed"]
+    restart_clicks = r["restart_clicks"]
+
+    return {
+        "kiosk_id": r["kiosk_id"],
+        "started": r["started"],
+        "completed": completed,
+        "abandoned": r["abandoned"],
+        "restart_clicks": restart_clicks,
+        "restart_rate": restart_clicks / completed if completed else 0.0,
+        "avg_ms": None, # Fills a missing slot in your React Row type
+        "avg_completed_ms": r["avg_completed_ms"],
+        "avg_abandoned_ms": r["avg_abandoned_ms"],
+        "download_app_clicks": r["download_app_clicks"],
+        "click_location_clicks": r["click_location_clicks"],
+        "back_to_map_sessions": r["back_to_map_sessions"],
+        "avg_easter_eggs": r["avg_easter_eggs"],
+        "avg_abandoned_screen_depth": r["avg_screen_depth"],
+        "poi_clicks": poi_clicks_from_row(r),
+    }
+
+@app.get("/metrics/overview")
+async def metrics_overview(
+    response: Response,
+    kiosk_id: Optional[str] = Query(default=None),
+    date_from: Optional[datetime] = Query(default=None),
+    date_to:   Optional[datetime] = Query(default=None),
+):
+    date_from, date_to = as_utc(date_from), as_utc(date_to)
+    response.headers["Cache-Control"] = READ_CACHE_CONTROL
+    key = ("metrics_overview", kiosk_id, date_from, date_to)
+    cached = cache_get(key)
+    if cached is not None:
+        return cached
+
+    sql = f"""
+        SELECT {METRIC_COLUMNS}
+        FROM sessions
+        WHERE ($1::timestamptz IS NULL OR started_at >= $1)
+          AND ($2::timestamptz IS NULL OR started_at <  $2)
+          AND ($3::text IS NULL OR kiosk_id = $3);
+    """
+    async with pool.acquire() as conn:
+        row = await conn.fetchrow(sql, date_from, date_to, kiosk_id)
+
+    return cache_put(key, overview_from_row(row, kiosk_id, date_from, date_to), METRICS_TTL)
+
+@app.get("/metrics/by-kiosk")
+async def metrics_by_kiosk(
+    response: Response,
+    date_from: Optional[datetime] = Query(default=None),
+    date_to:   Optional[datetime] = Query(default=None),
 ):
-    sql = """
+    date_from, date_to = as_utc(date_from), as_utc(date_to)
+    response.headers["Cache-Control"] = READ_CACHE_CONTROL
+    key = ("metrics_by_kiosk", date_from, date_to)
+    cached = cache_get(key)
+    if cached is not None:
+        return cached
+
+    sql = f"""
+        SELECT kiosk_id, {METRIC_COLUMNS}
+        FROM sessions
+        WHERE ($1::timestamptz IS NULL OR started_at >= $1)
+          AND ($2::timestamptz IS NULL OR started_at <  $2)
+        GROUP BY kiosk_id
+        ORDER BY kiosk_id;
+    """
+    async with pool.acquire() as conn:
+        rows = await conn.fetch(sql, date_from, date_to)
+
+    return cache_put(key, [by_kiosk_from_row(r) for r in rows], METRICS_TTL)
+
+@app.get("/metrics/combined")
+async def metrics_combined(
+    response: Response,
+    date_from: Optional[datetime] = Query(default=None),
+    date_to:   Optional[datetime] = Query(default=None),
+):
+    date_from, date_to = as_utc(date_from), as_utc(date_to)
+    # Overview and by-kiosk for the same window from a single scan of sessions
+    response.headers["Cache-Control"] = READ_CACHE_CONTROL
+    key = ("metrics_combined", date_from, date_to)
+    cached = cache_get(key)
+    if cached is not None:
+        return cached
+
+    # ROLLUP adds a grand-total row (GROUPING(kiosk_id) = 1) alongside the per-kiosk groups
+    sql = f"""
+        SELECT kiosk_id, GROUPING(kiosk_id) = 1 AS is_total, {METRIC_COLUMNS}
+        FROM sessions
+        WHERE ($1::timestamptz IS NULL OR started_at >= $1)
+          AND ($2::timestamptz IS NULL OR started_at <  $2)
+        GROUP BY ROLLUP (kiosk_id)
+        ORDER BY GROUPING(kiosk_id), kiosk_id;
+    """
+    async with pool.acquire() as conn:
+        rows = await conn.fetch(sql, date_from, date_to)
+
+    # ROLLUP always emits the grand-total row, even when the window is empty
+    total = next(r for r in rows if r["is_total"])
+    return cache_put(key, {
+        "overview": overview_from_row(total, None, date_from, date_to),
+        "by_kiosk": [by_kiosk_from_row(r) for r in rows if not r["is_total"]],
+    }, METRICS_TTL)
+
+CSV_QUEUE_CHUNKS = 16
+
+@app.get("/metrics/by-kiosk.csv")
+async def metrics_by_kiosk_csv(
+    date_from: Optional[datetime] = Query(default=None),
+    date_to:   Optional[datetime] = Query(default=None),
+):
+    date_from, date_to = as_utc(date_from), as_utc(date_to)
+    # copy_from_query inlines arguments as literals and turns None into an empty string, so
+    # only the filters that are set go into the WHERE clause and the argument list
+    args: List[datetime] = []
+    where = []
+    if date_from is not None:
+        args.append(date_from)
+        where.append(f"started_at >= ${len(args)}")
+    if date_to is not None:
+        args.append(date_to)
+        where.append(f"started_at < ${len(args)}")
+
+    # Rates and rounding are done in SQL; Postgres formats and quotes the CSV itself via COPY
+    sql = f"""
         SELECT
             kiosk_id,
             COUNT(*) AS started,
             COUNT(*) FILTER (WHERE completed_at IS NOT NULL) AS completed,
             COUNT(*) FILTER (WHERE abandoned_at IS NOT NULL) AS abandoned,
+            ROUND(COUNT(*) FILTER (WHERE completed_at IS NOT NULL)::numeric / NULLIF(COUNT(*), 0), 4) AS completion_pct,
             SUM(COALESCE(restart_clicks,0)) AS restart_clicks,
-            AVG(COALESCE(client_ms, EXTRACT(EPOCH FROM (completed_at - started_at)) * 1000)) FILTER (WHERE completed_at IS NOT NULL) AS avg_completed_ms,
-            AVG(COALESCE(client_ms, EXTRACT(EPOCH FROM (abandoned_at - started_at)) * 1000)) FILTER (WHERE abandoned_at IS NOT NULL) AS avg_abandoned_ms,
-            SUM((meta->>'download_app_clicks')::numeric) AS download_app_clicks,
-            SUM((meta->>'click_location_clicks')::numeric) AS click_location_clicks,
-            SUM((meta->>'back_to_map_clicks')::numeric) AS back_to_map_sessions,
-            AVG((meta->>'easter_eggs')::numeric) AS avg_easter_eggs,
-            AVG((meta->>'screenindex')::numeric) AS avg_screen_depth,
-            SUM((meta->'poi_clicks'->>'Priority Pass')::numeric) AS poi_1,
-            SUM((meta->'poi_clicks'->>'Barcode Booth')::numeric) AS poi_2,
-            SUM((meta->'poi_clicks'->>'Support Spotlight')::numeric) AS poi_3,
-            SUM((meta->'poi_clicks'->>'Self Service Station')::numeric) AS poi_4,
-            SUM((meta->'poi_clicks'->>'Cash Concession')::numeric) AS poi_5
+            ROUND(COALESCE(SUM(COALESCE(restart_clicks,0))::numeric / NULLIF(COUNT(*) FILTER (WHERE completed_at IS NOT NULL), 0), 0), 4) AS restart_rate,
+            ROUND(AVG(completed_ms) FILTER (WHERE completed_at IS NOT NULL)) AS avg_completed_ms,
+            ROUND(AVG(abandoned_ms) FILTER (WHERE abandoned_at IS NOT NULL)) AS avg_abandoned_ms
         FROM sessions
-        WHERE (%s::timestamptz IS NULL OR started_at >= %s::timestamptz)
-          AND (%s::timestamptz IS NULL OR started_at <  %s::timestamptz)
+        {"WHERE " + " AND ".join(where) if where else ""}
         GROUP BY kiosk_id
-        ORDER BY kiosk_id;
+        ORDER BY kiosk_id
     """
-    with pool.connection() as conn, conn.cursor() as cur:
-        cur.execute(sql, (date_from, date_from, date_to, date_to))
-        rows = cur.fetchall()
-        
-        result = []
-        for r in rows:
-            # Safely extract and cast our baseline variables
-            sessions_started = int(r.get("started") or 0)
-            sessions_completed = int(r.get("completed") or 0)
-            sessions_abandoned = int(r.get("abandoned") or 0)
-            restart_clicks = int(r.get("restart_clicks") or 0)
-            restart_rate = (float(restart_clicks) / float(sessions_completed)) if sessions_completed > 0 else 0.0
-
-            result.append({
-                "kiosk_id": r.get("kiosk_id"),
-                "started": sessions_started,
-                "completed": sessions_completed,
-                "abandoned": sessions_abandoned,
-                "restart_clicks": restart_clicks,
-                "restart_rate": restart_rate,
-                "avg_ms": None, # Fills a missing slot in your React Row type
-                "avg_completed_ms": float(r.get("avg_completed_ms")) if r.get("avg_completed_ms") is not None else None,
-                "avg_abandoned_ms": float(r.get("avg_abandoned_ms")) if r.get("avg_abandoned_ms") is not None else None,
-                "download_app_clicks": int(r.get("download_app_clicks") or 0),
-                "click_location_clicks": int(r.get("click_location_clicks") or 0),
-                "back_to_map_sessions": int(r.get("back_to_map_sessions") or 0),
-                "avg_easter_eggs": float(r.get("avg_easter_eggs")) if r.get("avg_easter_eggs") is not None else None,
-                "avg_abandoned_screen_depth": float(r.get("avg_screen_depth")) if r.get("avg_screen_depth") is not None else None,
-                "poi_clicks": {
-                    "Priority Pass": int(r.get("poi_1") or 0),
-                    "Barcode Booth": int(r.get("poi_2") or 0),
-                    "Support Spotlight": int(r.get("poi_3") or 0),
-                    "Self Service Station": int(r.get("poi_4") or 0),
-                    "Cash Concession": int(r.get("poi_5") or 0),
-                }
-            })
-            
-        return result
+
+    async def stream_copy():
+        # COPY pushes chunks into a small bounded queue that the response drains, so a slow
+        # client holds back the COPY instead of the output piling up in memory
+        chunks: asyncio.Queue = asyncio.Queue(maxsize=CSV_QUEUE_CHUNKS)
+
+        async def copy_out():
+            try:
+                async with pool.acquire() as conn:
+                    await conn.copy_from_query(
+                        sql, *args,
+                        output=chunks.put, format="csv", header=True,
+                    )
+            except Exception:
+                await chunks.put(None)
+                raise
+            await chunks.put(None)
+
+        task = asyncio.create_task(copy_out())
+        try:
+            while (chunk := await chunks.get()) is not None:
+                # COPY hands over bytearrays; StreamingResponse only passes bytes through as-is
+                yield bytes(chunk)
+            await task
+        finally:
+            task.cancel()
+
+    return StreamingResponse(
+        stream_copy(),
+        media_type="text/csv; charset=utf-8",
+        headers={"Content-Disposition": 'attachment; filename="metrics_by_kiosk.csv"'},
+    )
+
+# ----- Admin -----
+@app.get("/admin/hot-queries")
+async def hot_queries(conn: asyncpg.Connection = Depends(get_conn)):
+    # Top statements against sessions by total DB time, to check what each optimisation actually moved
+    try:
+        rows = await conn.fetch(
+            """
+            SELECT query, calls, mean_exec_time, total_exec_time
+            FROM pg_stat_statements
+            WHERE query ILIKE '%sessions%'
+            ORDER BY total_exec_time DESC
+            LIMIT 20;
+            """
+        )
+    except asyncpg.UndefinedTableError:
+        raise HTTPException(status_code=503, detail="pg_stat_statements is not installed")
+    return [dict(r) for r in rows]
 
 if __name__ == "__main__":
     import uvicorn
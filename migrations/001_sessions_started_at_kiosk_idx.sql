@@ -0,0 +1,4 @@
+-- Range filter used by every /metrics endpoint: started_at window, optionally narrowed by kiosk_id.
+-- CONCURRENTLY avoids locking out session writes while the index builds; run it outside a transaction.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS sessions_started_at_kiosk_idx
+    ON sessions (started_at, kiosk_id);
@@ -0,0 +1,4 @@
+-- Per-kiosk overview (/metrics/overview?kiosk_id=...): equality on kiosk_id, then the started_at range.
+-- Run outside a transaction.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS sessions_kiosk_started_at_idx
+    ON sessions (kiosk_id, started_at);
@@ -0,0 +1,16 @@
+-- Session lengths stored once at complete/abandon time, so metrics average a column instead of
+-- recomputing EXTRACT(EPOCH FROM ...) for every row on every query. A session can be both completed
+-- and abandoned, so each end event keeps its own duration and feeds only its own average.
+-- Apply before deploying the code that writes and reads completed_ms/abandoned_ms.
+ALTER TABLE sessions
+    ADD COLUMN IF NOT EXISTS completed_ms bigint,
+    ADD COLUMN IF NOT EXISTS abandoned_ms bigint;
+
+-- Backfill finished sessions with the values the metrics queries used to compute on the fly.
+UPDATE sessions
+SET completed_ms = COALESCE(completed_ms, CASE WHEN completed_at IS NOT NULL THEN
+        COALESCE(client_ms, (EXTRACT(EPOCH FROM (completed_at - started_at)) * 1000)::bigint) END),
+    abandoned_ms = COALESCE(abandoned_ms, CASE WHEN abandoned_at IS NOT NULL THEN
+        COALESCE(client_ms, (EXTRACT(EPOCH FROM (abandoned_at - started_at)) * 1000)::bigint) END)
+WHERE (completed_at IS NOT NULL AND completed_ms IS NULL)
+   OR (abandoned_at IS NOT NULL AND abandoned_ms IS NULL);
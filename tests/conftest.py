@@ -0,0 +1,74 @@
+"""Fixtures for tests that run against a real Postgres.
+
+Set TEST_DATABASE_URL to a disposable database and run ``python -m pytest`` from the repo root.
+The tables are created and migrations/ applied once, then emptied before each test.
+"""
+import asyncio
+import os
+import pathlib
+
+import pytest
+
+TEST_DATABASE_URL = os.environ.get("TEST_DATABASE_URL")
+API_KEY = "test-key"
+MIGRATIONS_DIR = pathlib.Path(__file__).resolve().parent.parent / "migrations"
+
+# The tables as they exist before migrations/
+BASE_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS kiosk_locations (
+        kiosk_id   text PRIMARY KEY,
+        kiosk_name text NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS sessions (
+        session_id     uuid PRIMARY KEY,
+        kiosk_id       text NOT NULL,
+        app_version    text,
+        started_at     timestamptz NOT NULL DEFAULT NOW(),
+        completed_at   timestamptz,
+        abandoned_at   timestamptz,
+        client_ms      integer,
+        meta           jsonb,
+        restart_clicks integer
+    );
+"""
+
+def run_sql(*statements) -> None:
+    # Each statement is (sql, *args), run on its own short-lived connection outside the app's pool
+    import asyncpg
+
+    async def go() -> None:
+        conn = await asyncpg.connect(TEST_DATABASE_URL)
+        try:
+            for sql, *args in statements:
+                await conn.execute(sql, *args)
+        finally:
+            await conn.close()
+
+    asyncio.run(go())
+
+@pytest.fixture(scope="session")
+def client():
+    if not TEST_DATABASE_URL:
+        pytest.skip("TEST_DATABASE_URL is not set")
+    pytest.importorskip("asyncpg")
+    pytest.importorskip("httpx")
+
+    # Migrations use CREATE INDEX CONCURRENTLY, so each file runs as its own statement
+    run_sql((BASE_SCHEMA,), *((path.read_text(),) for path in sorted(MIGRATIONS_DIR.glob("*.sql"))))
+
+    os.environ["DATABASE_URL"] = TEST_DATABASE_URL
+    os.environ["API_KEY"] = API_KEY
+
+    from fastapi.testclient import TestClient
+    import main
+
+    with TestClient(main.app, headers={"Authorization": f"Bearer {API_KEY}"}) as c:
+        yield c
+
+@pytest.fixture
+def db(client):
+    import main
+
+    run_sql(("TRUNCATE kiosk_locations, sessions;",))
+    main._read_cache.clear()
+    return run_sql
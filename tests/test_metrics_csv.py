@@ -0,0 +1,48 @@
+import csv
+import io
+
+import pytest
+
+@pytest.fixture
+def seeded(db):
+    db(
+        ("INSERT INTO kiosk_locations VALUES ('K1', 'Lobby'), ('K2', 'Gate');",),
+        ("""
+            INSERT INTO sessions (session_id, kiosk_id, started_at, completed_at, abandoned_at, restart_clicks)
+            VALUES
+                (gen_random_uuid(), 'K1', '2026-01-10T12:00:00Z', '2026-01-10T12:01:00Z', NULL, 1),
+                (gen_random_uuid(), 'K1', '2026-01-20T12:00:00Z', NULL, '2026-01-20T12:00:30Z', NULL),
+                (gen_random_uuid(), 'K2', '2026-03-01T12:00:00Z', '2026-03-01T12:02:00Z', NULL, 0);
+        """,),
+    )
+
+def fetch_csv(client, **params):
+    r = client.get("/metrics/by-kiosk.csv", params=params)
+    assert r.status_code == 200, r.text
+    assert r.headers["content-type"].startswith("text/csv")
+    return list(csv.DictReader(io.StringIO(r.text)))
+
+def test_csv_export_without_dates(client, seeded):
+    rows = fetch_csv(client)
+    assert [r["kiosk_id"] for r in rows] == ["K1", "K2"]
+    assert rows[0]["started"] == "2"
+    assert rows[0]["completed"] == "1"
+    assert rows[0]["abandoned"] == "1"
+    assert rows[0]["avg_completed_ms"] == "60000"
+    assert rows[0]["avg_abandoned_ms"] == "30000"
+    assert rows[1]["avg_completed_ms"] == "120000"
+
+def test_csv_export_with_dates(client, seeded):
+    rows = fetch_csv(client, date_from="2026-01-15T00:00:00Z", date_to="2026-02-01T00:00:00Z")
+    assert [r["kiosk_id"] for r in rows] == ["K1"]
+    assert rows[0]["started"] == "1"
+    assert rows[0]["abandoned"] == "1"
+
+def test_csv_export_with_only_date_from(client, seeded):
+    rows = fetch_csv(client, date_from="2026-02-01T00:00:00Z")
+    assert [r["kiosk_id"] for r in rows] == ["K2"]
+
+def test_dates_without_offset_are_utc(client, seeded):
+    rows = fetch_csv(client, date_from="2026-01-20T12:00:00", date_to="2026-01-20T12:00:01")
+    assert [r["kiosk_id"] for r in rows] == ["K1"]
+    assert rows[0]["started"] == "1"
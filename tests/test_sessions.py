@@ -0,0 +1,76 @@
+import uuid
+
+import pytest
+
+@pytest.fixture
+def kiosk(db):
+    db(("INSERT INTO kiosk_locations VALUES ('K1', 'Lobby');",))
+    return "K1"
+
+def post(client, path, body):
+    r = client.post(path, json=body)
+    assert r.status_code == 200, r.text
+    return r.json()
+
+def overview(client):
+    r = client.get("/metrics/overview")
+    assert r.status_code == 200, r.text
+    return r.json()
+
+def start(client, kiosk_id):
+    session_id = str(uuid.uuid4())
+    post(client, "/session/start", {"kiosk_id": kiosk_id, "session_id": session_id})
+    return session_id
+
+def test_each_end_event_keeps_its_own_duration(client, kiosk):
+    a = start(client, kiosk)
+    b = start(client, kiosk)
+    post(client, "/session/complete", {"session_id": a, "kiosk_id": kiosk, "client_ms": 60000})
+    post(client, "/session/abandon", {"session_id": a, "kiosk_id": kiosk, "client_ms": 90000})
+    post(client, "/session/abandon", {"session_id": b, "kiosk_id": kiosk, "client_ms": 30000})
+
+    m = overview(client)
+    assert m["sessions_started"] == 2
+    assert m["sessions_completed"] == 1
+    assert m["sessions_abandoned"] == 2
+    assert m["avg_completed_ms"] == 60000
+    assert m["avg_abandoned_ms"] == 60000
+
+def test_server_duration_when_client_ms_is_missing(client, db, kiosk):
+    session_id = str(uuid.uuid4())
+    db((
+        "INSERT INTO sessions (session_id, kiosk_id, started_at) VALUES ($1, $2, NOW() - interval '10 minutes');",
+        uuid.UUID(session_id), kiosk,
+    ))
+    post(client, "/session/complete", {"session_id": session_id, "kiosk_id": kiosk})
+    post(client, "/session/abandon", {"session_id": session_id, "kiosk_id": kiosk, "client_ms": 5000})
+
+    m = overview(client)
+    assert m["avg_completed_ms"] >= 600000
+    assert m["avg_abandoned_ms"] == 5000
+
+def test_offline_complete_inserts_the_session(client, kiosk):
+    session_id = str(uuid.uuid4())
+    post(client, "/session/complete", {"session_id": session_id, "kiosk_id": kiosk, "client_ms": 45000, "meta": {"screenindex": 3}})
+    post(client, "/session/complete/bulk", [{"session_id": str(uuid.uuid4()), "kiosk_id": kiosk, "client_ms": 15000}])
+
+    m = overview(client)
+    assert m["sessions_completed"] == 2
+    assert m["avg_completed_ms"] == 30000
+
+def test_bulk_complete_merges_spellings_of_one_session(client, kiosk):
+    session_id = uuid.uuid4()
+    r = post(client, "/session/complete/bulk", [
+        {"session_id": str(session_id), "kiosk_id": kiosk, "client_ms": 10000},
+        {"session_id": "{%s}" % str(session_id).upper(), "kiosk_id": kiosk, "client_ms": 20000},
+    ])
+    assert len(r["session_ids"]) == 1
+
+    m = overview(client)
+    assert m["sessions_completed"] == 1
+    assert m["avg_completed_ms"] == 20000
+
+@pytest.mark.parametrize("path", ["/session/start/bulk", "/session/complete/bulk", "/session/restart/bulk"])
+def test_bulk_rejects_malformed_session_id(client, kiosk, path):
+    r = client.post(path, json=[{"session_id": "not-a-uuid", "kiosk_id": kiosk}])
+    assert r.status_code == 422